@@ -1,4 +1,6 @@
 import streamlit as st
+import csv
+import io
 import os
 import pandas as pd
 import tempfile
@@ -7,14 +9,29 @@ import json
 import toml
 from datetime import datetime, timedelta
 import time
-from io import BytesIO
+import re
 import zipfile
 import sqlite3
+import msgpack
+import logging
 
-# Import components directly from files
-import gmail_component
-import processing_component
-import teams_component
+logger = logging.getLogger(__name__)
+
+# Components are imported lazily: they pull in the Google, Gemini and MSAL
+# SDKs, which would otherwise be paid on every script rerun.
+import importlib
+
+@st.cache_resource
+def _gmail():
+    return importlib.import_module('gmail_component')
+
+@st.cache_resource
+def _processing():
+    return importlib.import_module('processing_component')
+
+@st.cache_resource
+def _teams():
+    return importlib.import_module('teams_component')
 
 # Set page config with a more appealing icon
 st.set_page_config(
@@ -142,7 +159,8 @@ st.markdown("""
 </style>
 """, unsafe_allow_html=True)
 
-# Load config from secrets.toml
+# Load config from secrets.toml (parsed once per process, not per rerun)
+@st.cache_resource
 def load_config():
     if hasattr(st, 'secrets'):
         return st.secrets
@@ -156,6 +174,14 @@ def load_config():
 MAPPING_FILE = "payee_mappings.csv"
 MAPPING_COLUMNS = ['Payee', 'Teams_Folder'] # <<< REMOVED GL_Code
 
+@st.cache_data(ttl=60)
+def _read_mapping_csv(mtime):
+    """Reads the mapping CSV with the multi-threaded Arrow parser.
+
+    The mtime argument keys the cache so edits on disk invalidate it.
+    """
+    return pd.read_csv(MAPPING_FILE, engine="pyarrow", dtype=str).fillna("")
+
 def load_mapping_data():
     """Loads the payee mapping data from the CSV file."""
     if not os.path.exists(MAPPING_FILE):
@@ -163,8 +189,10 @@ def load_mapping_data():
         df.to_csv(MAPPING_FILE, index=False)
         return df
     try:
-        return pd.read_csv(MAPPING_FILE, dtype=str).fillna("")
-    except pd.errors.EmptyDataError:
+        return _read_mapping_csv(os.path.getmtime(MAPPING_FILE))
+    except (pd.errors.EmptyDataError, pd.errors.ParserError):
+        # The pyarrow engine reports an empty file as ParserError rather
+        # than EmptyDataError; treat both as "no mappings yet".
         return pd.DataFrame(columns=MAPPING_COLUMNS)
     except Exception as e:
         st.error(f"Critical error loading mapping file: {e}")
@@ -173,9 +201,9 @@ def load_mapping_data():
 def save_mapping_data(df):
     """Saves the mapping DataFrame to the CSV file."""
     try:
-        df = df.astype(str)
-        df.dropna(subset=['Payee'], inplace=True)
-        df.drop_duplicates(subset=['Payee'], keep='last', inplace=True)
+        df = (df.astype(str)
+                .dropna(subset=['Payee'])
+                .drop_duplicates(subset=['Payee'], keep='last'))
         df.to_csv(MAPPING_FILE, index=False)
         return True
     except Exception as e:
@@ -183,73 +211,279 @@ def save_mapping_data(df):
         return False
 
 # Database functions for persistent storage
-def init_db():
-    conn = sqlite3.connect('echeque_processing.db', isolation_level=None)
+DB_FILE = 'echeque_processing.db'
+
+# WAL is a persistent database property, so these only need to run once per DB
+# file (init_db), but busy_timeout/cache settings are per-connection.
+DB_PRAGMAS = """
+PRAGMA journal_mode=WAL;
+PRAGMA synchronous=NORMAL;
+PRAGMA temp_store=MEMORY;
+PRAGMA cache_size=-20000;
+PRAGMA busy_timeout=5000;
+"""
+
+@st.cache_resource
+def get_rw_conn():
+    """Returns the single long-lived writer connection shared across reruns."""
+    conn = sqlite3.connect(DB_FILE, check_same_thread=False, isolation_level=None)
+    conn.executescript(DB_PRAGMAS)
+    return conn
+
+@st.cache_resource
+def get_ro_conn():
+    """Returns a read-only connection; under WAL readers never block the writer."""
+    conn = sqlite3.connect(f"file:{DB_FILE}?mode=ro", uri=True, check_same_thread=False)
+    conn.execute("PRAGMA busy_timeout=5000")
+    return conn
+
+# Binary payloads get their own BLOB columns; JSON only carries small metadata.
+# The tuple fixes the column order; the frozenset serves C-speed membership
+# tests against dict keys.
+BLOB_FIELDS = ('content', 'pdf', 'original_pdf', 'pdf_data')
+_BLOB_FIELD_SET = frozenset(BLOB_FIELDS)
+
+DB_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS processed_files (
+    filename TEXT PRIMARY KEY,
+    processed_date TEXT,
+    meta BLOB,
+    content BLOB,
+    pdf BLOB,
+    original_pdf BLOB,
+    pdf_data BLOB
+)
+'''
+
+def _migrate_legacy_db(conn):
+    """One-time migration from the old base64-in-JSON 'data' column layout."""
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(processed_files)")}
+    if 'data' not in columns:
+        return
     c = conn.cursor()
-    c.execute('''
-    CREATE TABLE IF NOT EXISTS processed_files (
-        filename TEXT PRIMARY KEY,
-        processed_date TEXT,
-        data TEXT
+    c.execute("BEGIN IMMEDIATE")
+    c.execute("ALTER TABLE processed_files RENAME TO processed_files_legacy")
+    c.execute(DB_SCHEMA)
+    for filename, processed_date, data in conn.execute(
+            "SELECT filename, processed_date, data FROM processed_files_legacy").fetchall():
+        file_data = json.loads(data)
+        blobs = []
+        for field in BLOB_FIELDS:
+            if file_data.pop(f'_{field}_is_base64', False) and field in file_data:
+                blobs.append(base64.b64decode(file_data.pop(field)))
+            else:
+                blobs.append(None)
+        c.execute(
+            "INSERT OR REPLACE INTO processed_files VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (filename, processed_date, msgpack.packb(file_data, use_bin_type=True), *blobs)
+        )
+    c.execute("DROP TABLE processed_files_legacy")
+    conn.commit()
+
+def init_db():
+    conn = get_rw_conn()
+    conn.execute(DB_SCHEMA)
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS staged_uploads (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        filename TEXT,
+        blob BLOB
     )
     ''')
-    conn.close()
+    _migrate_legacy_db(conn)
+
+def stage_uploaded_file(filename, data):
+    """Parks manually uploaded PDF bytes in SQLite; returns the rowid."""
+    conn = get_rw_conn()
+    c = conn.cursor()
+    c.execute("BEGIN IMMEDIATE")
+    c.execute("INSERT INTO staged_uploads (filename, blob) VALUES (?, ?)",
+              (filename, sqlite3.Binary(data)))
+    rowid = c.lastrowid
+    conn.commit()
+    return rowid
+
+def get_file_content(file_info):
+    """Returns the raw bytes for a downloaded/uploaded file.
+
+    Gmail downloads keep their bytes in the dict; staged manual uploads
+    are fetched from SQLite by rowid so they don't sit in session state.
+    """
+    content = file_info.get('content')
+    if content is None and 'staged_rowid' in file_info:
+        row = get_ro_conn().execute(
+            "SELECT blob FROM staged_uploads WHERE id = ?",
+            (file_info['staged_rowid'],)
+        ).fetchone()
+        content = row[0] if row else b''
+    return content if content is not None else b''
+
+# Multi-page PDFs are stored one row per page under "name.pdf (page N)";
+# the skip filter needs the bare source name back for rows written before
+# source_filename was recorded.
+_PAGE_SUFFIX = re.compile(r' \(page \d+\)$')
 
 def load_from_db():
-    conn = sqlite3.connect('echeque_processing.db')
+    """Loads lightweight metadata for every processed file.
+
+    The multi-MB PDF blobs stay in SQLite until something actually needs
+    them; fetch those on demand with load_blob/get_pdf_data.
+    """
+    conn = get_ro_conn()
     c = conn.cursor()
-    c.execute("SELECT filename FROM processed_files")
-    filenames = {row[0] for row in c.fetchall()}
-    c.execute("SELECT data FROM processed_files")
+    c.execute("SELECT filename, meta FROM processed_files")
+    filenames = set()
     files_data = []
-    for row in c.fetchall():
-        file_data = json.loads(row[0])
-        binary_fields = ['content', 'pdf', 'original_pdf', 'pdf_data']
-        for field in binary_fields:
-            field_base64_key = f'_{field}_is_base64'
-            if field_base64_key in file_data and file_data[field_base64_key]:
-                if field in file_data:
-                    file_data[field] = base64.b64decode(file_data[field])
-                del file_data[field_base64_key]
-        files_data.append(file_data)
-    conn.close()
+    for filename, meta in c.fetchall():
+        data = msgpack.unpackb(meta, raw=False)
+        filenames.add(data.get('source_filename') or _PAGE_SUFFIX.sub('', filename))
+        files_data.append(data)
     return filenames, files_data
 
-def save_to_db(processed_file):
-    conn = sqlite3.connect('echeque_processing.db')
-    c = conn.cursor()
+def load_blob(filename, field='pdf_data'):
+    """Fetches a single binary payload for one processed file on demand."""
+    if field not in BLOB_FIELDS:
+        raise ValueError(f"Unknown blob field: {field}")
+    row = get_ro_conn().execute(
+        f"SELECT {field} FROM processed_files WHERE filename = ?", (filename,)
+    ).fetchone()
+    return row[0] if row else None
+
+def load_pdf_blobs(processed_files):
+    """Bulk-fetches missing PDF bytes for a batch of processed files.
+
+    One SELECT instead of a query per file; dicts that already hold their
+    bytes are left untouched.
+    """
+    missing = {}
+    for pf in processed_files:
+        if pf.get('pdf_data') is None:
+            filename = pf.get('original_filename') or pf.get('generated_filename')
+            missing.setdefault(filename, []).append(pf)
+    if not missing:
+        return
+    placeholders = ', '.join('?' * len(missing))
+    rows = get_ro_conn().execute(
+        f"SELECT filename, pdf_data FROM processed_files WHERE filename IN ({placeholders})",
+        list(missing)
+    ).fetchall()
+    for filename, blob in rows:
+        for pf in missing[filename]:
+            pf['pdf_data'] = blob
+
+def get_pdf_data(processed_file):
+    """Returns the PDF bytes for a processed file, pulling from the DB if needed."""
+    data = processed_file.get('pdf_data')
+    if data is None:
+        filename = processed_file.get('original_filename') or processed_file.get('generated_filename')
+        data = load_blob(filename)
+        processed_file['pdf_data'] = data  # keep for the rest of the session
+    return data
+
+def _diagnose(storage_file):
+    """Finds which keys of a processed-file dict fail to serialize."""
+    problematic_keys = []
+    for key, value in storage_file.items():
+        try:
+            msgpack.packb({key: value}, use_bin_type=True)
+        except TypeError:
+            problematic_keys.append(f"{key} (type: {type(value)})")
+    return ', '.join(problematic_keys)
+
+def _serialize(processed_file):
+    """Builds the (filename, processed_date, meta, *blobs) row for one processed file."""
     filename = processed_file.get('original_filename') or processed_file.get('generated_filename')
     processed_date = datetime.now().isoformat()
     storage_file = processed_file.copy()
-    binary_fields = ['content', 'pdf', 'original_pdf', 'pdf_data']
-    for field in binary_fields:
-        if field in storage_file and isinstance(storage_file[field], bytes):
-            storage_file[field] = base64.b64encode(storage_file[field]).decode('utf-8')
-            storage_file[f'_{field}_is_base64'] = True
+    # Producers always hand us bytes for these fields, so a set intersection
+    # replaces the per-field membership + isinstance checks.
+    present = _BLOB_FIELD_SET.intersection(storage_file)
+    blobs = []
+    for field in BLOB_FIELDS:
+        value = storage_file.pop(field, None) if field in present else None
+        blobs.append(sqlite3.Binary(value) if value is not None else None)
     try:
-        data_json = json.dumps(storage_file)
-    except TypeError as e:
-        problematic_keys = []
-        for key, value in storage_file.items():
-            try:
-                json.dumps({key: value})
-            except TypeError:
-                problematic_keys.append(f"{key} (type: {type(value)})")
-        raise TypeError(f"Cannot JSON serialize these keys: {', '.join(problematic_keys)}") from e
-    c.execute(
-        "INSERT OR REPLACE INTO processed_files (filename, processed_date, data) VALUES (?, ?, ?)",
-        (filename, processed_date, data_json)
+        meta = msgpack.packb(storage_file, use_bin_type=True)
+    except TypeError:
+        # Per-key re-serialization is O(keys x value size); only pay for it
+        # when someone is actually debugging.
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Unserializable keys in %s: %s", filename, _diagnose(storage_file))
+        raise
+    return (filename, processed_date, meta, *blobs)
+
+def save_rows_to_db(rows):
+    """Writes pre-serialized rows inside a single transaction."""
+    if not rows:
+        return
+    conn = get_rw_conn()
+    c = conn.cursor()
+    c.execute("BEGIN IMMEDIATE")
+    c.executemany(
+        "INSERT OR REPLACE INTO processed_files VALUES (?, ?, ?, ?, ?, ?, ?)",
+        rows
     )
     conn.commit()
-    conn.close()
+
+def save_many_to_db(processed_files):
+    """Saves a batch of processed files inside a single transaction."""
+    save_rows_to_db([_serialize(pf) for pf in processed_files])
+
+def save_to_db(processed_file):
+    save_many_to_db([processed_file])
 
 def create_zip_from_files(files):
-    zip_buffer = BytesIO()
-    with zipfile.ZipFile(zip_buffer, 'w') as zip_file:
-        for file in files:
-            zip_file.writestr(file['filename'], file['content'])
-    zip_buffer.seek(0)
-    return zip_buffer.getvalue()
+    """Builds a ZIP of the given files, spilling to disk past 64MB.
+
+    PDFs are already compressed, so ZIP_STORED skips pointless DEFLATE work.
+    Returns the archive as bytes: st.download_button only accepts str/bytes
+    and the BytesIO family, not arbitrary file-likes such as the spooled
+    temp file used during assembly. Entries use a fixed timestamp so
+    identical inputs produce identical archives.
+    """
+    with tempfile.SpooledTemporaryFile(max_size=64 * 1024 * 1024) as buf:
+        with zipfile.ZipFile(buf, 'w', zipfile.ZIP_STORED) as zip_file:
+            for file in files:
+                info = zipfile.ZipInfo(file['filename'], date_time=(1980, 1, 1, 0, 0, 0))
+                zip_file.writestr(info, file['content'])
+        buf.seek(0)
+        return buf.read()
+
+# The download buttons pass these as callables, so no archive is built
+# until the user actually clicks. Memoization on a cheap key (filenames +
+# sizes) then keeps repeat clicks and reruns from rebuilding an unchanged
+# set; cache_resource returns the bytes without the copy cache_data's
+# pickling round-trip would make.
+@st.cache_resource(max_entries=4)
+def _attachments_zip(key, _files):
+    return create_zip_from_files(_files)
+
+@st.cache_resource(max_entries=4)
+def _processed_zip(key, _processed_files):
+    load_pdf_blobs(_processed_files)
+    return create_zip_from_files(
+        [{'filename': pf['generated_filename'], 'content': get_pdf_data(pf)} for pf in _processed_files]
+    )
+
+def attachments_zip(files):
+    return _attachments_zip(tuple((f['filename'], f.get('size', len(f.get('content', b'')))) for f in files), files)
+
+def processed_zip(processed_files):
+    return _processed_zip(tuple(pf['generated_filename'] for pf in processed_files), processed_files)
+
+UPLOAD_REPORT_COLUMNS = ["Filename", "Status", "Target Folder", "Error"]
+
+def upload_results_frame(upload_results):
+    # Tuples + from_records skip the per-row dict allocation and key-based
+    # column inference of the dict-comprehension DataFrame constructor.
+    rows = [
+        (r['filename'],
+         "✅ Success" if r['success'] else "❌ Failed",
+         r.get('target_folder', 'Unknown'),
+         r.get('error', '') if not r['success'] else '')
+        for r in upload_results
+    ]
+    return pd.DataFrame.from_records(rows, columns=UPLOAD_REPORT_COLUMNS)
 
 config = load_config()
 init_db()
@@ -295,16 +529,22 @@ with tabs[0]:
                 gmail_secrets = config.get('gmail', {})
                 progress_container = st.container(); progress_placeholder = progress_container.empty()
                 def progress_callback(message): progress_placeholder.info(message)
-                downloaded_files, error = gmail_component.search_and_download_echeques(gmail_secrets, start_date, end_date, progress_callback=progress_callback)
+                downloaded_files, error = _gmail().search_and_download_echeques(gmail_secrets, start_date, end_date, progress_callback=progress_callback)
                 if error and not downloaded_files: st.error(f"Error: {error}")
                 elif not downloaded_files: st.warning("No e-Cheques found in the date range. Try expanding your search or uploading files manually.")
                 else:
                     st.markdown(f'<div class="success-box">✅ Successfully downloaded {len(downloaded_files)} e-Cheques!</div>', unsafe_allow_html=True)
                     st.markdown('<div class="subheader">Downloaded e-Cheques</div>', unsafe_allow_html=True)
-                    file_data = [{"Filename": f.get('filename', 'Unknown'), "Email Subject": f.get('email_subject', 'Unknown'), "Email Date": f.get('email_date', 'Unknown'), "Size": f"{len(f.get('content', b'')) / 1024:.1f} KB"} for f in downloaded_files]
-                    st.dataframe(pd.DataFrame(file_data), use_container_width=True)
+                    # Columnar build: pandas infers each dtype once instead of per row
+                    size_kb = [len(f.get('content', b'')) / 1024 for f in downloaded_files]
+                    st.dataframe(pd.DataFrame({
+                        "Filename": [f.get('filename', 'Unknown') for f in downloaded_files],
+                        "Email Subject": [f.get('email_subject', 'Unknown') for f in downloaded_files],
+                        "Email Date": [f.get('email_date', 'Unknown') for f in downloaded_files],
+                        "Size": [f"{s:.1f} KB" for s in size_kb],
+                    }), use_container_width=True)
                     st.session_state.downloaded_files = downloaded_files
-                    if downloaded_files: st.download_button(label="📥 Download All Attachments as ZIP", data=create_zip_from_files(downloaded_files), file_name="email_attachments.zip", mime="application/zip")
+                    if downloaded_files: st.download_button(label="📥 Download All Attachments as ZIP", data=lambda: attachments_zip(downloaded_files), file_name="email_attachments.zip", mime="application/zip")
                     st.markdown('<div class="info-box"><strong>Next:</strong> Proceed to Step 2 (Process) to extract data from these e-cheques.</div>', unsafe_allow_html=True)
             except Exception as e: st.error(f"An error occurred: {str(e)}")
     st.markdown("---")
@@ -313,17 +553,30 @@ with tabs[0]:
     uploaded_files = st.file_uploader("Drop PDF files here or click to browse", type=['pdf'], accept_multiple_files=True, help="Upload one or more PDF files containing e-cheques")
     if uploaded_files:
         if st.button("📤 Add Uploaded Files"):
-            new_files = [{'filename': f.name, 'content': f.read(), 'email_subject': 'Manual Upload', 'email_date': datetime.now().strftime('%Y-%m-%d %H:%M:%S'), 'size': len(f.getvalue())} for f in uploaded_files]
+            new_files = []
+            for f in uploaded_files:
+                data = f.getvalue()
+                rowid = stage_uploaded_file(f.name, data)
+                new_files.append({'filename': f.name, 'staged_rowid': rowid, 'email_subject': 'Manual Upload', 'email_date': datetime.now().strftime('%Y-%m-%d %H:%M:%S'), 'size': len(data)})
             st.session_state.downloaded_files.extend(new_files)
             st.markdown(f'<div class="success-box">✅ Added {len(new_files)} files to the download list</div>', unsafe_allow_html=True)
             st.rerun()
     if st.session_state.downloaded_files and not submit_button:
         st.markdown('<div class="subheader">Files Ready for Processing</div>', unsafe_allow_html=True)
-        file_data = [{"Filename": f.get('filename', 'Unknown'), "Source": f.get('email_subject', 'Manual Upload'), "Date": f.get('email_date', datetime.now().strftime('%Y-%m-%d %H:%M:%S')), "Size": f"{len(f.get('content', b'')) / 1024:.1f} KB"} for f in st.session_state.downloaded_files]
-        st.dataframe(file_data, use_container_width=True)
+        ready_files = st.session_state.downloaded_files
+        size_kb = [f.get('size', len(f.get('content', b''))) / 1024 for f in ready_files]
+        st.dataframe({
+            "Filename": [f.get('filename', 'Unknown') for f in ready_files],
+            "Source": [f.get('email_subject', 'Manual Upload') for f in ready_files],
+            "Date": [f.get('email_date', datetime.now().strftime('%Y-%m-%d %H:%M:%S')) for f in ready_files],
+            "Size": [f"{s:.1f} KB" for s in size_kb],
+        }, use_container_width=True)
         col1, col2 = st.columns([1, 4])
         with col1:
-            if st.button("🗑️ Clear Files"): st.session_state.downloaded_files = []; st.rerun()
+            if st.button("🗑️ Clear Files"):
+                st.session_state.downloaded_files = []
+                conn = get_rw_conn(); conn.execute("DELETE FROM staged_uploads"); conn.commit()
+                st.rerun()
 
 # STEP 2: PROCESSING TAB - UNCHANGED
 with tabs[1]:
@@ -334,8 +587,12 @@ with tabs[1]:
     else:
         st.markdown('<div class="subheader">Files Ready for Processing</div>', unsafe_allow_html=True)
         skip_processed = st.checkbox("Skip already processed files", value=True, help="When checked, files that have been previously processed will be skipped.")
-        files_to_process = [f for f in st.session_state.downloaded_files if not (skip_processed and f['filename'] in st.session_state.processed_filenames)]
-        skipped_files = [f['filename'] for f in st.session_state.downloaded_files if skip_processed and f['filename'] in st.session_state.processed_filenames]
+        # Bind once: every `in st.session_state.x` goes through the SessionState
+        # proxy, which adds up over large file lists.
+        downloaded = st.session_state.downloaded_files
+        seen = frozenset(st.session_state.processed_filenames) if skip_processed else frozenset()
+        files_to_process = [f for f in downloaded if f['filename'] not in seen]
+        skipped_files = [f['filename'] for f in downloaded if f['filename'] in seen]
         if skipped_files: st.info(f"Skipping {len(skipped_files)} previously processed files")
         if not files_to_process: st.warning("All files have already been processed. Uncheck 'Skip already processed files' to reprocess.")
         else:
@@ -344,8 +601,7 @@ with tabs[1]:
             if st.session_state.processed_files:
                 st.markdown("---")
                 st.markdown('<div class="subheader">Download Previously Processed Files</div>', unsafe_allow_html=True)
-                zip_files = [{'filename': pf['generated_filename'], 'content': pf['pdf_data']} for pf in st.session_state.processed_files]
-                st.download_button(label="📥 Download All Processed Files as ZIP", data=create_zip_from_files(zip_files), file_name=f"all_processed_echeques_{datetime.now().strftime('%Y%m%d_%H%M%S')}.zip", mime="application/zip")
+                st.download_button(label="📥 Download All Processed Files as ZIP", data=lambda: processed_zip(st.session_state.processed_files), file_name=f"all_processed_echeques_{datetime.now().strftime('%Y%m%d_%H%M%S')}.zip", mime="application/zip")
         gemini_api_key = config.get('gemini', {}).get('api_key', '')
         if st.button("🔍 Process e-Cheques"):
             if not gemini_api_key: st.error("Gemini API key is not configured. Please contact your administrator.")
@@ -357,29 +613,51 @@ with tabs[1]:
                         def progress_callback(message, progress=None):
                             progress_placeholder.info(message)
                             if progress is not None: progress_bar.progress(progress)
-                        processed_files, errors = processing_component.process_echeques(files_to_process, gemini_api_key, progress_callback=progress_callback)
-                        for file in processed_files:
-                            if file not in st.session_state.processed_files: st.session_state.processed_files.append(file)
-                        for processed_file in processed_files: save_to_db(processed_file)
-                        for file in files_to_process: st.session_state.processed_filenames.add(file['filename'])
+                        # Staged manual uploads hold their bytes in SQLite, not the dict
+                        batch = [dict(f, content=get_file_content(f)) for f in files_to_process]
+                        processed_files, errors = _processing().process_echeques(batch, gemini_api_key, progress_callback=progress_callback)
+                        # Single pass: append or replace in session state, serialize
+                        # DB rows and accumulate the results columns together. A
+                        # duplicate generated_filename means the cheque was
+                        # reprocessed, so the fresh extraction replaces the session
+                        # entry and still reaches the DB (INSERT OR REPLACE).
+                        rows = []
+                        col_orig, col_gen, col_payee, col_amount, col_date, col_folder = [], [], [], [], [], []
+                        session_files = st.session_state.processed_files
+                        positions = {pf['generated_filename']: i for i, pf in enumerate(session_files)}
+                        for pf in processed_files:
+                            pos = positions.get(pf['generated_filename'])
+                            if pos is None:
+                                positions[pf['generated_filename']] = len(session_files)
+                                session_files.append(pf)
+                            else:
+                                session_files[pos] = pf
+                            rows.append(_serialize(pf))
+                            data = pf['original_data']
+                            col_orig.append(pf.get('original_filename', 'Unknown'))
+                            col_gen.append(pf['generated_filename'])
+                            col_payee.append(data.get('payee', 'Unknown'))
+                            col_amount.append(f"{data.get('currency', '')} {data.get('amount_numerical', 'Unknown')}")
+                            col_date.append(data.get('date', 'Unknown'))
+                            col_folder.append(data.get('Teams_Folder', 'Not Mapped'))
+                        save_rows_to_db(rows)
+                        st.session_state.processed_filenames.update(f['filename'] for f in files_to_process)
                         if processed_files:
                             st.markdown(f'<div class="success-box">✅ Successfully processed {len(processed_files)} e-cheques!</div>', unsafe_allow_html=True)
                             st.markdown('<div class="subheader">Processing Results</div>', unsafe_allow_html=True)
-                            results_data = []
-                            for result in processed_files:
-                                data = result['original_data']
-                                results_data.append({
-                                    "Original Filename": result.get('original_filename', 'Unknown'),
-                                    "Generated Filename": result['generated_filename'],
-                                    "Payee": data.get('payee', 'Unknown'),
-                                    "Amount": f"{data.get('currency', '')} {data.get('amount_numerical', 'Unknown')}",
-                                    "Date": data.get('date', 'Unknown'),
-                                    "Teams Folder": data.get('Teams_Folder', 'Not Mapped')
-                                    # <<< REMOVED GL Code from results table
-                                })
-                            st.dataframe(pd.DataFrame(results_data), use_container_width=True)
-                            zip_files = [{'filename': pf['generated_filename'], 'content': pf['pdf_data']} for pf in processed_files]
-                            st.download_button(label="📥 Download Newly Processed Files as ZIP", data=create_zip_from_files(zip_files), file_name=f"processed_echeques_{datetime.now().strftime('%Y%m%d_%H%M%S')}.zip", mime="application/zip")
+                            # Every column is text; declaring the dtype skips
+                            # inference and halves memory vs object columns.
+                            results_df = pd.DataFrame({
+                                "Original Filename": col_orig,
+                                "Generated Filename": col_gen,
+                                "Payee": col_payee,
+                                "Amount": col_amount,
+                                "Date": col_date,
+                                "Teams Folder": col_folder,
+                                # <<< REMOVED GL Code from results table
+                            }).astype('string')
+                            st.dataframe(results_df, use_container_width=True)
+                            st.download_button(label="📥 Download Newly Processed Files as ZIP", data=lambda: processed_zip(processed_files), file_name=f"processed_echeques_{datetime.now().strftime('%Y%m%d_%H%M%S')}.zip", mime="application/zip")
                             st.markdown('<div class="info-box"><strong>Next:</strong> Proceed to Step 3 (Upload) to send these files to Microsoft Teams.</div>', unsafe_allow_html=True)
                             if errors:
                                 with st.expander("Processing Errors"):
@@ -407,8 +685,8 @@ with tabs[2]:
             if 'upload_results' in st.session_state: del st.session_state.upload_results
             if 'select_all_files' in st.session_state: st.session_state.select_all_files = False
             try:
-                conn = sqlite3.connect('echeque_processing.db'); c = conn.cursor()
-                c.execute("DELETE FROM processed_files"); conn.commit(); conn.close()
+                conn = get_rw_conn(); c = conn.cursor()
+                c.execute("BEGIN IMMEDIATE"); c.execute("DELETE FROM processed_files"); c.execute("DELETE FROM staged_uploads"); conn.commit()
                 st.success("Successfully cleared all files!"); time.sleep(1); st.rerun()
             except Exception as e: st.error(f"Error clearing database: {str(e)}")
     with col2: st.info("Click 'Clear All Files' to permanently remove all downloaded and processed files from the system.")
@@ -427,11 +705,19 @@ with tabs[2]:
             if 'upload_results' in st.session_state and st.button("Reset Upload Status"):
                 if 'upload_results' in st.session_state: del st.session_state.upload_results
                 st.rerun()
-        selected_files = []
-        with st.container():
-            for i, file in enumerate(st.session_state.processed_files):
-                if st.checkbox(f"{file['generated_filename']}", value=st.session_state.select_all_files, key=f"pdf_{i}"):
-                    selected_files.append(file)
+        # One table render instead of one checkbox widget per file
+        select_df = pd.DataFrame({
+            'Select': [st.session_state.select_all_files] * len(st.session_state.processed_files),
+            'Filename': [f['generated_filename'] for f in st.session_state.processed_files],
+        })
+        edited_selection = st.data_editor(
+            select_df,
+            disabled=['Filename'],
+            hide_index=True,
+            use_container_width=True,
+            key="file_selector"
+        )
+        selected_files = [st.session_state.processed_files[i] for i in edited_selection.index[edited_selection['Select']]]
         if selected_files: st.markdown(f"**{len(selected_files)} files selected for upload**")
         else: st.warning("Please select at least one file to upload")
         if st.button("📤 Upload to Teams"):
@@ -445,7 +731,8 @@ with tabs[2]:
                             progress_placeholder.info(message)
                             if progress is not None: progress_bar.progress(progress)
                         if len(selected_files) > 1: progress_placeholder.info(f"Preparing to upload {len(selected_files)} files in batch...")
-                        upload_results, error, _, _ = teams_component.upload_files_to_teams(selected_files, teams_creds.get('client_id', ''), teams_creds.get('client_secret', ''), teams_creds.get('tenant_id', ''), finance_team_id, progress_callback=progress_callback)
+                        load_pdf_blobs(selected_files)  # pull lazily-loaded PDFs out of the DB in one query
+                        upload_results, error, _, _ = _teams().upload_files_to_teams(selected_files, teams_creds.get('client_id', ''), teams_creds.get('client_secret', ''), teams_creds.get('tenant_id', ''), finance_team_id, progress_callback=progress_callback)
                         st.session_state.upload_results = upload_results
                         if error: st.error(f"Teams upload failed: {error}")
                         elif upload_results:
@@ -453,19 +740,23 @@ with tabs[2]:
                             if success_count == len(upload_results): st.markdown(f'<div class="success-box">✅ Successfully uploaded all {len(upload_results)} files to Teams!</div>', unsafe_allow_html=True)
                             else: st.warning(f"Uploaded {success_count} out of {len(upload_results)} files to Teams.")
                             st.markdown('<div class="subheader">Upload Results</div>', unsafe_allow_html=True)
-                            results_data = [{"Filename": r['filename'], "Status": "✅ Success" if r['success'] else "❌ Failed", "Target Folder": r.get('target_folder', 'Unknown'), "Error": r.get('error', '') if not r['success'] else ''} for r in upload_results]
-                            results_df = pd.DataFrame(results_data)
+                            results_df = upload_results_frame(upload_results)
                             st.dataframe(results_df, use_container_width=True)
                             if success_count > 0:
                                 st.markdown('<div class="info-box"><strong>Complete!</strong> The e-cheques have been successfully uploaded to Teams.</div>', unsafe_allow_html=True)
-                                csv_data = results_df.to_csv(index=False)
+                                # csv.writer streams rows directly; to_csv builds
+                                # the whole string through pandas' slower path
+                                buf = io.StringIO()
+                                w = csv.writer(buf)
+                                w.writerow(results_df.columns)
+                                w.writerows(results_df.itertuples(index=False, name=None))
+                                csv_data = buf.getvalue()
                                 st.download_button(label="📊 Download Upload Report as CSV", data=csv_data, file_name=f"teams_upload_report_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv", mime="text/csv")
                     except Exception as e: st.error(f"An error occurred during Teams upload: {str(e)}")
         if 'upload_results' in st.session_state and st.session_state.upload_results:
             st.markdown("---")
             st.markdown('<div class="subheader">Previous Upload Results</div>', unsafe_allow_html=True)
-            results_data = [{"Filename": r['filename'], "Status": "✅ Success" if r['success'] else "❌ Failed", "Target Folder": r.get('target_folder', 'Unknown'), "Error": r.get('error', '') if not r['success'] else ''} for r in st.session_state.upload_results]
-            st.dataframe(pd.DataFrame(results_data), use_container_width=True)
+            st.dataframe(upload_results_frame(st.session_state.upload_results), use_container_width=True)
 
 # MAPPING MANAGEMENT TAB - SIMPLIFIED
 with tabs[3]:
@@ -494,6 +785,8 @@ with tabs[3]:
     st.markdown("---")
     if st.button("💾 Save Changes to Mapping File", type="primary"):
         if save_mapping_data(edited_df):
+            # Drop stale cached frames so the editor reloads the saved file
+            _read_mapping_csv.clear()
             st.success("✅ Mapping rules have been saved successfully!")
             time.sleep(1)
             st.rerun()
@@ -1,12 +1,17 @@
-import base64
-import json
+import asyncio
+import copy
+import csv
+import functools
+import hashlib
 import fitz  # PyMuPDF
+import orjson
 import os
 import re
-import pandas as pd
 import google.generativeai as genai
-import time
+from concurrent.futures import ProcessPoolExecutor
+from aiolimiter import AsyncLimiter
 from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception_type
+from tenacity import AsyncRetrying
 
 # --- Configuration ---
 MAPPING_FILE = "payee_mappings.csv"
@@ -14,6 +19,8 @@ MAPPING_COLUMNS = ["Payee", "Teams_Folder"]
 MAX_RETRIES = 5
 INITIAL_WAIT = 1
 MAX_WAIT = 32
+MAX_CONCURRENCY = 8  # in-flight Gemini requests per batch
+REQUESTS_PER_MINUTE = 60  # Gemini quota is per minute, not per second
 
 TRUST_ACCOUNT_PAYER = "WMC NOMINEE LIMITED-CLIENT TRUST ACCOUNT"
 WMC_PAYER = "WEALTH MANAGEMENT CUBE LIMITED"
@@ -70,71 +77,153 @@ def generate_prompt(override_prompt: str = "") -> str:
     """
     return prompt
 
+# --- Response schema ---
+# Mirrors the schema embedded in the prompt. Passing it as response_schema
+# with a JSON mime type makes the API emit constrained JSON directly, so
+# markdown fences and chatty preambles can't appear; the regex extraction
+# further down stays as a cheap safety net for override prompts.
+ECHEQUE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "bank_name": {"type": "string"},
+        "date": {"type": "string"},
+        "payee": {"type": "string"},
+        "payer": {"type": "string"},
+        "amount_numerical": {"type": "string"},
+        "amount_words": {"type": "string"},
+        "cheque_number": {"type": "string"},
+        "key_identifier": {"type": "string"},
+        "currency": {"type": "string"},
+        "remarks": {"type": "string"},
+        "is_trailer_fee": {"type": "boolean"},
+        "is_management_fee": {"type": "boolean"},
+        "next_step": {"type": "string"},
+    },
+    "required": [
+        "date", "payee", "amount_numerical", "key_identifier",
+        "payer", "next_step", "is_trailer_fee", "is_management_fee",
+    ],
+}
+
+_SINGLE_PAGE_CONFIG = genai.GenerationConfig(
+    temperature=0.0,
+    response_mime_type="application/json",
+    response_schema=ECHEQUE_SCHEMA,
+)
+# Multi-page requests ask for one object per page, in page order.
+_MULTI_PAGE_CONFIG = genai.GenerationConfig(
+    temperature=0.0,
+    response_mime_type="application/json",
+    response_schema={"type": "array", "items": ECHEQUE_SCHEMA},
+)
+
 # --- Mappings ---
 def load_mappings(file_path=MAPPING_FILE):
-    """Loads payee mappings from CSV. Ensures expected columns exist."""
+    """Loads payee mappings from CSV.
+
+    Returns (lookup, error): a precomputed {standardized payee: Teams_Folder}
+    dict so per-cheque lookups are O(1). Uses the stdlib csv module — the
+    mapping file is small and the processing path never needs a DataFrame
+    (the editor UI in app.py keeps its own pandas loader).
+    """
     try:
+        lookup = {}
         if os.path.exists(file_path):
-            df = pd.read_csv(file_path, dtype=str).fillna("")
-        else:
-            df = pd.DataFrame(columns=MAPPING_COLUMNS)
-        # Ensure required columns present
-        for col in MAPPING_COLUMNS:
-            if col not in df.columns:
-                df[col] = ""
-        return df, None
+            with open(file_path, newline="", encoding="utf-8-sig") as f:
+                for row in csv.DictReader(f):
+                    payee = (row.get("Payee") or "").strip()
+                    if payee:
+                        # Normalize here too, so lookups need no per-call cleanup
+                        lookup[_standardize(payee)] = (row.get("Teams_Folder") or "").strip()
+        return lookup, None
     except Exception as e:
-        # Return empty but shaped DataFrame plus error message
-        return pd.DataFrame(columns=MAPPING_COLUMNS), f"Error loading mappings: {str(e)}"
+        return {}, f"Error loading mappings: {str(e)}"
 
+_WHITESPACE = re.compile(r"\s+")
+
+@functools.lru_cache(maxsize=4096)
 def _standardize(s: str) -> str:
-    """Uppercase, strip, and collapse internal whitespace."""
+    """Uppercase, strip, and collapse internal whitespace.
+
+    Memoized: the same payer/payee strings recur across a batch (the payer
+    constants on every cheque), so repeat calls are a cache hit.
+    """
     if s is None:
         return ""
-    return " ".join(str(s).upper().strip().split())
+    return _WHITESPACE.sub(" ", str(s).upper().strip())
 
-def get_mapping_info(payee, mappings_df):
+# Standardized once at import time; the payer constants never change.
+_TRUST_STD = _standardize(TRUST_ACCOUNT_PAYER)
+
+def get_mapping_info(payee, mapping_lookup):
     """Returns Teams_Folder for a given payee, or 'Uncategorized'."""
-    if mappings_df.empty or payee is None:
+    if not mapping_lookup or payee is None:
         return "Uncategorized"
-    payee_std = _standardize(payee)
-    if "Standardized_Name" not in mappings_df.columns:
-        mappings_df["Standardized_Name"] = mappings_df["Payee"].astype(str).map(_standardize)
-    match = mappings_df[mappings_df["Standardized_Name"] == payee_std]
-    if not match.empty:
-        folder = str(match.iloc[0].get("Teams_Folder", "")).strip()
-        return folder if folder else "Uncategorized"
-    return "Uncategorized"
-
-def get_filename_alias(payee: str, payer: str, mappings_df) -> str:
+    return mapping_lookup.get(_standardize(payee)) or "Uncategorized"
+
+def get_filename_alias(payee: str, payer: str, mapping_lookup) -> str:
     """
     Old naming system behavior using the new CSV:
     - If payer is the TRUST_ACCOUNT_PAYER: use original payee (no alias).
     - Else: use Teams_Folder as the alias when available; otherwise fall back to original payee.
     """
-    if _standardize(payer) == _standardize(TRUST_ACCOUNT_PAYER):
+    if _standardize(payer) == _TRUST_STD:
         return payee or ""
     # Use Teams_Folder as "short form" alias when present
-    folder = get_mapping_info(payee, mappings_df)
+    folder = get_mapping_info(payee, mapping_lookup)
     return folder if folder and folder != "Uncategorized" else (payee or "")
 
 # --- PDF to image ---
+# Gemini Vision downscales anything much beyond ~1k px on the long side, so
+# rendering larger than this is wasted encode CPU and upload bytes.
+TARGET_PIXELS = 1600
+# JPEG at this quality is visually lossless for cheque scans but encodes
+# faster and uploads at a fraction of the PNG size.
+JPEG_QUALITY = 82
+
+def pdf_to_images(pdf_bytes):
+    """Converts every page of a PDF from bytes into a list of JPEG byte strings."""
+    try:
+        # Context manager guarantees the MuPDF context is torn down even when
+        # rasterization raises; the old explicit close() leaked on errors.
+        with fitz.open(stream=pdf_bytes, filetype="pdf") as pdf_document:
+            if pdf_document.page_count == 0:
+                return None, "Uploaded PDF is empty."
+            images = []
+            for page in pdf_document:
+                zoom = TARGET_PIXELS / max(page.rect.width, page.rect.height)
+                mat = fitz.Matrix(zoom, zoom)
+                pix = page.get_pixmap(matrix=mat, alpha=False)
+                images.append(pix.tobytes("jpeg", jpg_quality=JPEG_QUALITY))
+        return images, None
+    except Exception as e:
+        return None, f"Error converting PDF to image: {str(e)}"
+
 def pdf_to_image(pdf_bytes):
-    """Converts the first page of a PDF from bytes into a PNG byte string."""
+    """Converts just the first page of a PDF into a JPEG byte string."""
     try:
-        pdf_document = fitz.open(stream=pdf_bytes, filetype="pdf")
-        if pdf_document.page_count == 0:
-            return None, "Uploaded PDF is empty."
-        page = pdf_document.load_page(0)
-        mat = fitz.Matrix(4, 4)
-        pix = page.get_pixmap(matrix=mat, alpha=False)
-        img_bytes = pix.tobytes("png")
-        pdf_document.close()
+        with fitz.open(stream=pdf_bytes, filetype="pdf") as pdf_document:
+            if pdf_document.page_count == 0:
+                return None, "Uploaded PDF is empty."
+            page = pdf_document.load_page(0)
+            zoom = TARGET_PIXELS / max(page.rect.width, page.rect.height)
+            mat = fitz.Matrix(zoom, zoom)
+            pix = page.get_pixmap(matrix=mat, alpha=False)
+            img_bytes = pix.tobytes("jpeg", jpg_quality=JPEG_QUALITY)
         return img_bytes, None
     except Exception as e:
         return None, f"Error converting PDF to image: {str(e)}"
 
 # --- Gemini calls ---
+@functools.lru_cache(maxsize=4)
+def _get_model(api_key):
+    """Returns a configured GenerativeModel, built once per API key."""
+    genai.configure(api_key=api_key)
+    return genai.GenerativeModel(
+        "gemini-2.5-flash",
+        generation_config=_SINGLE_PAGE_CONFIG,
+    )
+
 @retry(
     retry=retry_if_exception_type(APIRateLimitError),
     wait=wait_exponential(multiplier=INITIAL_WAIT, max=MAX_WAIT),
@@ -159,16 +248,10 @@ def call_gemini_api(image_bytes, prompt, api_key):
     if not api_key:
         return None, "Missing Gemini API key."
     try:
-        genai.configure(api_key=api_key)
-        model = genai.GenerativeModel(
-            "gemini-2.5-flash",
-            generation_config=genai.GenerationConfig(temperature=0.0),
-        )
-        image_parts = [{"mime_type": "image/png", "data": base64.b64encode(image_bytes).decode("utf-8")}]
+        model = _get_model(api_key)
+        image_parts = [{"mime_type": "image/jpeg", "data": image_bytes}]
         prompt_parts = [prompt, image_parts[0]]
 
-        time.sleep(1)  # polite delay
-
         try:
             text = call_gemini_api_with_retry(model, prompt_parts)
             return text, None
@@ -180,9 +263,11 @@ def call_gemini_api(image_bytes, prompt, api_key):
         return None, f"Error in API configuration: {str(e)}"
 
 # --- Filename helpers ---
+_FILENAME_BAD = re.compile(r'[\/*?:"<>|]')
+
 def sanitize_filename(filename):
     """Removes characters that are invalid for filenames."""
-    return re.sub(r'[\/*?:"<>|]', "_", str(filename or "")).strip()
+    return _FILENAME_BAD.sub("_", str(filename or "")).strip()
 
 def generate_filename(key_identifier, payer, payee_for_filename, currency, is_trailer_fee, is_management_fee):
     """
@@ -212,25 +297,76 @@ def generate_filename(key_identifier, payer, payee_for_filename, currency, is_tr
     else:
         return f"{sanitized_payee}_{key_identifier}_{currency}{suffix}.pdf"
 
-# --- Core processing ---
-def process_echeque(pdf_data, gemini_api_key, mappings_df, custom_prompt=""):
-    """Processes a single e-cheque PDF, extracts data, and applies mapping rules."""
-    # Convert PDF to image
-    image_bytes, error = pdf_to_image(pdf_data)
-    if error:
-        return None, error
+# --- Async Gemini call path ---
+async def _generate_with_retry_async(model, prompt_parts, generation_config=None):
+    """Async counterpart of call_gemini_api_with_retry with the same backoff."""
+    text = None
+    async for attempt in AsyncRetrying(
+        retry=retry_if_exception_type(APIRateLimitError),
+        wait=wait_exponential(multiplier=INITIAL_WAIT, max=MAX_WAIT),
+        stop=stop_after_attempt(MAX_RETRIES),
+        reraise=True,
+    ):
+        with attempt:
+            try:
+                response = await model.generate_content_async(
+                    prompt_parts, generation_config=generation_config
+                )
+                if not response:
+                    raise APIRateLimitError("Empty response from API")
+                text = response.text.strip()
+            except APIRateLimitError:
+                raise
+            except Exception as e:
+                msg = str(e)
+                if "429" in msg or "resource has been exhausted" in msg.lower():
+                    raise APIRateLimitError(f"Rate limit exceeded: {msg}")
+                raise
+    return text
+
+async def call_gemini_api_async(image_bytes_list, prompt, api_key):
+    """Calls the Gemini Vision API with one or more page images in one request."""
+    if not api_key:
+        return None, "Missing Gemini API key."
+    try:
+        model = _get_model(api_key)
+        # The SDK takes raw bytes directly; base64-encoding here only added
+        # an extra O(image) copy before the SDK re-encoded anyway.
+        prompt_parts = [prompt] + [
+            {"mime_type": "image/jpeg", "data": image_bytes}
+            for image_bytes in image_bytes_list
+        ]
+
+        # Override the model's single-object schema when several pages went
+        # out in one request and an array is expected back.
+        config = _MULTI_PAGE_CONFIG if len(image_bytes_list) > 1 else None
 
-    # Build prompt and call model
-    prompt = generate_prompt(custom_prompt)
-    raw_response, error = call_gemini_api(image_bytes, prompt, gemini_api_key)
-    if error:
-        return None, error
+        try:
+            text = await _generate_with_retry_async(model, prompt_parts, config)
+            return text, None
+        except APIRateLimitError as e:
+            return None, f"API rate limit error after {MAX_RETRIES} retries: {e}"
+        except Exception as e:
+            return None, f"Unexpected error during API call: {e}"
+    except Exception as e:
+        return None, f"Error in API configuration: {str(e)}"
 
-    # Parse model response
+# --- Core processing ---
+# Grabs the outermost {...} (or [...] for multi-page responses) block,
+# tolerating markdown fences or stray text around the model's JSON without
+# allocating intermediate string copies.
+_JSON_RE = re.compile(r"\{.*\}", re.S)
+_JSON_ANY_RE = re.compile(r"\[.*\]|\{.*\}", re.S)
+
+MULTI_PAGE_NOTE = """
+This request contains {n} cheque images, one per PDF page, in order.
+Return a JSON array with one object per image, in the same order.
+Return only the JSON array with no additional text or formatting.
+"""
+
+def _apply_rules(parsed_json, pdf_data, mapping_lookup):
+    """Validates one parsed cheque object and applies the mapping/naming rules."""
     try:
-        clean_response = raw_response.strip().replace("```json", "").replace("```", "")
-        parsed_json = json.loads(clean_response)
-
         required_fields = ["date", "payee", "key_identifier", "payer", "currency", "is_trailer_fee", "is_management_fee"]
         missing = [f for f in required_fields if f not in parsed_json]
         if missing:
@@ -240,12 +376,12 @@ def process_echeque(pdf_data, gemini_api_key, mappings_df, custom_prompt=""):
         payer_name = parsed_json.get("payer", "")
 
         # Teams_Folder for routing (always compute and attach)
-        teams_folder = get_mapping_info(payee_name, mappings_df)
+        teams_folder = get_mapping_info(payee_name, mapping_lookup)
         parsed_json["Teams_Folder"] = teams_folder
 
         # Old naming system using the new CSV:
         # - Use Teams_Folder as alias unless payer is trust account; then use original payee
-        payee_alias_for_filename = get_filename_alias(payee_name, payer_name, mappings_df)
+        payee_alias_for_filename = get_filename_alias(payee_name, payer_name, mapping_lookup)
 
         filename = generate_filename(
             key_identifier=parsed_json["key_identifier"],
@@ -262,45 +398,162 @@ def process_echeque(pdf_data, gemini_api_key, mappings_df, custom_prompt=""):
             "pdf_data": pdf_data,
         }, None
 
-    except json.JSONDecodeError as e:
-        sample = raw_response[:500] if isinstance(raw_response, str) else str(raw_response)[:500]
-        return None, f"Error parsing JSON response: {e}. Response was: {sample}"
     except Exception as e:
         return None, f"Error processing e-cheque: {e}"
 
-def process_echeques(downloaded_files, gemini_api_key, progress_callback=None):
-    """Processes a batch of e-cheque files."""
-    processed_files = []
-    errors = []
+def _extract_json(raw_response, pattern):
+    """Pulls the JSON payload out of a raw model response."""
+    try:
+        match = pattern.search(raw_response)
+        if not match:
+            sample = raw_response[:500] if isinstance(raw_response, str) else str(raw_response)[:500]
+            return None, f"No JSON found in API response. Response was: {sample}"
+        return orjson.loads(match.group(0)), None
+    except orjson.JSONDecodeError as e:
+        sample = raw_response[:500] if isinstance(raw_response, str) else str(raw_response)[:500]
+        return None, f"Error parsing JSON response: {e}. Response was: {sample}"
 
-    mappings_df, mapping_error = load_mappings()
-    if mapping_error:
-        print(f"WARNING: Could not load mapping file. {mapping_error}")
+def _build_result(raw_response, pdf_data, mapping_lookup):
+    """Parses a single-cheque Gemini response and applies the rules."""
+    parsed_json, error = _extract_json(raw_response, _JSON_RE)
+    if error:
+        return None, error
+    return _apply_rules(parsed_json, pdf_data, mapping_lookup)
 
-    total_files = len(downloaded_files)
-    for i, file_info in enumerate(downloaded_files):
-        try:
-            # Progress notification (supports both 1-arg and 2-arg callbacks)
-            if progress_callback:
-                msg = f"Processing file {i + 1}/{total_files}: {file_info.get('filename', 'Unknown')}"
-                progress = (i + 1) / total_files if total_files else 1.0
-                try:
-                    progress_callback(msg, progress)
-                except TypeError:
-                    progress_callback(msg)
-
-            if i > 0:
-                time.sleep(2)  # gentle throttling between files
-
-            result, error = process_echeque(file_info["content"], gemini_api_key, mappings_df)
+def _build_results(raw_response, pdf_data, mapping_lookup):
+    """Parses a possibly multi-page Gemini response into one result per cheque."""
+    parsed, error = _extract_json(raw_response, _JSON_ANY_RE)
+    if error:
+        return None, error
+    if isinstance(parsed, dict):
+        parsed = [parsed]
+    results = []
+    for i, obj in enumerate(parsed):
+        result, error = _apply_rules(obj, pdf_data, mapping_lookup)
+        if error:
+            return None, f"Page {i + 1}: {error}"
+        results.append(result)
+    return results, None
+
+def process_echeque(pdf_data, gemini_api_key, mapping_lookup, custom_prompt=""):
+    """Processes a single e-cheque PDF, extracts data, and applies mapping rules."""
+    # Convert PDF to image
+    image_bytes, error = pdf_to_image(pdf_data)
+    if error:
+        return None, error
+
+    # Build prompt and call model
+    prompt = generate_prompt(custom_prompt)
+    raw_response, error = call_gemini_api(image_bytes, prompt, gemini_api_key)
+    if error:
+        return None, error
+
+    return _build_result(raw_response, pdf_data, mapping_lookup)
+
+def _content_key(pdf_bytes):
+    return hashlib.blake2b(pdf_bytes, digest_size=16).hexdigest()
+
+async def _process_one_async(file_info, gemini_api_key, mapping_lookup, sem, limiter, pool):
+    """Processes one file: rasterize in the worker pool, then call Gemini.
+
+    Rasterization happens outside the semaphore so PDFs render across
+    cores while earlier files wait on the network. All pages of a
+    multi-page PDF go out in one request, so a file yields a list of
+    results. Returns (file_info, results, error) so completion order
+    doesn't matter.
+    """
+    try:
+        loop = asyncio.get_running_loop()
+        # CPU-bound MuPDF work runs in a separate process, bypassing the GIL
+        images, error = await loop.run_in_executor(pool, pdf_to_images, file_info["content"])
+        if error:
+            return file_info, None, error
+
+        async with sem, limiter:
+            prompt = generate_prompt()
+            if len(images) > 1:
+                prompt += MULTI_PAGE_NOTE.format(n=len(images))
+            raw_response, error = await call_gemini_api_async(images, prompt, gemini_api_key)
             if error:
-                errors.append({"filename": file_info.get("filename", "Unknown"), "error": error})
-                continue
+                return file_info, None, error
 
-            result["original_filename"] = file_info.get("filename", "Unknown")
-            processed_files.append(result)
+        results, error = _build_results(raw_response, file_info["content"], mapping_lookup)
+        return file_info, results, error
+    except Exception as e:
+        return file_info, None, f"An unexpected error occurred: {e}"
 
-        except Exception as e:
-            errors.append({"filename": file_info.get("filename", "Unknown"), "error": f"An unexpected error occurred: {e}"})
+async def _copy_result_async(file_info, primary_task):
+    """Resolves a duplicate PDF from the task already processing those bytes."""
+    _, results, error = await primary_task
+    if error:
+        return file_info, None, error
+    # Deep copy so per-file annotation doesn't leak between duplicates
+    return file_info, copy.deepcopy(results), None
+
+async def _process_all_async(downloaded_files, gemini_api_key, mapping_lookup, progress_callback=None, pool=None):
+    """Runs the whole batch concurrently, bounded by MAX_CONCURRENCY."""
+    sem = asyncio.Semaphore(MAX_CONCURRENCY)
+    limiter = AsyncLimiter(REQUESTS_PER_MINUTE, 60)
+    # Identical PDFs in the batch (the same cheque attached to several
+    # emails) share one rasterize-and-Gemini task; duplicates just await it
+    # and copy its results. The map lives only for this batch, so mapping
+    # edits between runs are always honored and nothing is pinned in RAM.
+    primary_tasks = {}
+    tasks = []
+    for file_info in downloaded_files:
+        key = _content_key(file_info["content"])
+        primary = primary_tasks.get(key)
+        if primary is None:
+            task = asyncio.create_task(
+                _process_one_async(file_info, gemini_api_key, mapping_lookup, sem, limiter, pool)
+            )
+            primary_tasks[key] = task
+        else:
+            task = asyncio.create_task(_copy_result_async(file_info, primary))
+        tasks.append(task)
+
+    processed_files = []
+    errors = []
+    total_files = len(tasks)
+    for i, future in enumerate(asyncio.as_completed(tasks)):
+        file_info, results, error = await future
+
+        # Progress notification (supports both 1-arg and 2-arg callbacks)
+        if progress_callback:
+            msg = f"Processed file {i + 1}/{total_files}: {file_info.get('filename', 'Unknown')}"
+            progress = (i + 1) / total_files if total_files else 1.0
+            try:
+                progress_callback(msg, progress)
+            except TypeError:
+                progress_callback(msg)
+
+        if error:
+            errors.append({"filename": file_info.get("filename", "Unknown"), "error": error})
+        else:
+            source_name = file_info.get("filename", "Unknown")
+            for page_no, result in enumerate(results, start=1):
+                # Keep per-page records distinct for multi-page PDFs, but
+                # also record the bare source name so the skip filter can
+                # match the downloaded file across sessions.
+                result["source_filename"] = source_name
+                result["original_filename"] = (
+                    source_name if len(results) == 1 else f"{source_name} (page {page_no})"
+                )
+                processed_files.append(result)
 
     return processed_files, errors
+
+def process_echeques(downloaded_files, gemini_api_key, progress_callback=None):
+    """Processes a batch of e-cheque files with bounded concurrency.
+
+    The hot path is Gemini network latency, so files are processed as
+    concurrent asyncio tasks instead of one at a time.
+    """
+    mapping_lookup, mapping_error = load_mappings()
+    if mapping_error:
+        print(f"WARNING: Could not load mapping file. {mapping_error}")
+
+    with ProcessPoolExecutor(max_workers=min(os.cpu_count() or 1, 4)) as pool:
+        return asyncio.run(
+            _process_all_async(downloaded_files, gemini_api_key, mapping_lookup, progress_callback, pool=pool)
+        )